@@ -1,12 +1,18 @@
 """ansible enables running on first boot either ansible-pull"""
 import abc
+import functools
+import json
 import logging
 import os
+import pwd
 import re
+import site
+import subprocess
 import sys
 import sysconfig
-from copy import deepcopy
-from typing import Optional
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Optional
 
 from cloudinit import subp
 from cloudinit.cloud import Cloud
@@ -26,6 +32,15 @@ meta: MetaSchema = {
 LOG = logging.getLogger(__name__)
 CFG_OVERRIDE = "ansible_config"
 
+# require at least one dot so stray single digits don't match
+_ANSIBLE_VERSION_RE = re.compile(r"\d+(?:\.\d+)+")
+
+# fixed per interpreter, so probe once at import instead of paying a
+# sysconfig lookup and a stat() on every install
+_EXTERNALLY_MANAGED = os.path.exists(
+    os.path.join(sysconfig.get_path("stdlib"), "EXTERNALLY-MANAGED")
+)
+
 
 class AnsiblePull(abc.ABC):
     def __init__(self, distro: Distro):
@@ -34,23 +49,79 @@ class AnsiblePull(abc.ABC):
         self.distro = distro
         self.env = {}
         self.run_user: Optional[str] = None
+        self._installed_cache: Optional[bool] = None
+        self._version_cache: Optional[Version] = None
+        self._version_queried = False
 
         # some ansible modules directly reference os.environ["HOME"]
         # and cloud-init might not have that set, default: /root
         self.env["HOME"] = os.environ.get("HOME", "/root")
 
-    def get_version(self) -> Optional[Version]:
-        stdout, _ = self.do_as(self.cmd_version)
-        first_line = stdout.splitlines().pop(0)
-        matches = re.search(r"([\d\.]+)", first_line)
-        if matches:
-            version = matches.group(0)
-            return Version.from_str(version)
-        return None
+        # transport tuning: pipelining avoids one SSH round-trip per
+        # task and ControlPersist reuses a single connection per host;
+        # values already present in the environment win so deployments
+        # can opt out of these defaults
+        if "ANSIBLE_PIPELINING" not in os.environ:
+            self.env["ANSIBLE_PIPELINING"] = "True"
+        if "ANSIBLE_SSH_ARGS" not in os.environ:
+            self.env[
+                "ANSIBLE_SSH_ARGS"
+            ] = "-C -o ControlMaster=auto -o ControlPersist=60s"
 
-    def pull(self, *args) -> str:
-        stdout, _ = self.do_as([*self.cmd_pull, *args])
-        return stdout
+    def get_version(self) -> Optional[Version]:
+        # the installed ansible version can't change between calls, so
+        # fork ansible-pull --version at most once per instance
+        if not self._version_queried:
+            stdout, _ = self.do_as(self.cmd_version)
+            first_line = stdout.partition("\n")[0]
+            matches = _ANSIBLE_VERSION_RE.search(first_line)
+            if matches:
+                self._version_cache = Version.from_str(matches.group(0))
+            self._version_queried = True
+        return self._version_cache
+
+    def pull(self, *args) -> None:
+        """Run ansible-pull, streaming its output as it is produced.
+
+        Verbose playbook runs can emit megabytes of task output;
+        forwarding each line as it arrives avoids buffering it all in
+        memory and surfaces progress in real time.
+        """
+        command = [*self.cmd_pull, *args]
+        if self.run_user:
+            # mirror distro.do_as()'s su invocation
+            command = [
+                "su",
+                "-",
+                self.run_user,
+                "-c",
+                "env PATH=$PATH " + " ".join(command),
+            ]
+        # merge stderr into the streamed stdout: with a separate
+        # stderr pipe the child could fill it and block while we are
+        # still draining stdout, deadlocking first boot
+        process = subprocess.Popen(
+            command,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            env={**os.environ, **self.env},
+            bufsize=1,
+            text=True,
+        )
+        assert process.stdout is not None  # stdout=PIPE above
+        # keep a bounded tail of output for error reporting
+        tail: deque = deque(maxlen=100)
+        for line in process.stdout:
+            sys.stdout.write(line)
+            tail.append(line)
+        process.wait()
+        if process.returncode != 0:
+            raise subp.ProcessExecutionError(
+                cmd=command,
+                exit_code=process.returncode,
+                stdout="".join(tail),
+                stderr="",
+            )
 
     def check_deps(self):
         if not self.is_installed():
@@ -74,21 +145,49 @@ class AnsiblePull(abc.ABC):
 
 
 class AnsiblePullPip(AnsiblePull):
+    # userbase paths don't change while cloud-init runs, so share
+    # lookups between instances, keyed by username
+    _userbase_cache: Dict[str, str] = {}
+
     def __init__(self, distro: Distro, user: Optional[str]):
         super().__init__(distro)
         self.run_user = user
 
         # Add pip install site to PATH
-        user_base, _ = self.do_as(
-            [sys.executable, "-c", "'import site; print(site.getuserbase())'"]
-        )
-        ansible_path = f"{user_base}/bin/"
+        ansible_path = f"{self._get_user_base()}/bin/"
         old_path = self.env.get("PATH")
         if old_path:
             self.env["PATH"] = ":".join([old_path, ansible_path])
         else:
             self.env["PATH"] = ansible_path
 
+    def _get_user_base(self) -> str:
+        """pip's install site, without forking an interpreter to ask"""
+        cache_key = self.run_user or ""
+        user_base = self._userbase_cache.get(cache_key)
+        if user_base is not None:
+            return user_base
+        if not self.run_user:
+            user_base = site.getuserbase()
+        else:
+            # the POSIX userbase is derivable from the user's homedir;
+            # only fall back to a python subprocess when that guess
+            # doesn't exist on disk
+            try:
+                user_base = f"{pwd.getpwnam(self.run_user).pw_dir}/.local"
+            except KeyError:
+                user_base = ""
+            if not user_base or not os.path.isdir(user_base):
+                user_base, _ = self.do_as(
+                    [
+                        sys.executable,
+                        "-c",
+                        "'import site; print(site.getuserbase())'",
+                    ]
+                )
+        self._userbase_cache[cache_key] = user_base
+        return user_base
+
     def install(self, pkg_name: str):
         """should cloud-init grow an interface for non-distro package
         managers? this seems reusable
@@ -105,20 +204,31 @@ class AnsiblePullPip(AnsiblePull):
                 "pip",
                 "install",
             ]
-            if os.path.exists(
-                os.path.join(
-                    sysconfig.get_path("stdlib"), "EXTERNALLY-MANAGED"
-                )
-            ):
+            if _EXTERNALLY_MANAGED:
                 cmd.append("--break-system-packages")
             if self.run_user:
                 cmd.append("--user")
-            self.do_as([*cmd, "--upgrade", "pip"])
-            self.do_as([*cmd, pkg_name])
+            # one pip invocation upgrades pip and installs the package,
+            # instead of paying interpreter startup and resolver warmup
+            # twice
+            try:
+                self.do_as([*cmd, "--upgrade", "pip", pkg_name])
+            except subp.ProcessExecutionError:
+                # some environments refuse an in-place pip self-upgrade;
+                # retry with the requested package alone
+                self.do_as([*cmd, pkg_name])
+            self._installed_cache = True
 
     def is_installed(self) -> bool:
-        stdout, _ = self.do_as([sys.executable, "-m", "pip", "list"])
-        return "ansible" in stdout
+        # pip show resolves a single distribution by name, unlike pip
+        # list which enumerates the metadata of every installed package
+        if self._installed_cache is None:
+            try:
+                self.do_as([sys.executable, "-m", "pip", "show", "ansible"])
+                self._installed_cache = True
+            except subp.ProcessExecutionError:
+                self._installed_cache = False
+        return self._installed_cache
 
 
 class AnsiblePullDistro(AnsiblePull):
@@ -156,18 +266,91 @@ def handle(name: str, cfg: Config, cloud: Cloud, args: list) -> None:
 
         if ansible_config:
             ansible.env[CFG_OVERRIDE] = ansible_config
+            # environment variables take precedence over ansible.cfg
+            # settings, so drop our transport defaults and let the
+            # user's config file control them
+            ansible.env.pop("ANSIBLE_PIPELINING", None)
+            ansible.env.pop("ANSIBLE_SSH_ARGS", None)
 
         if galaxy_cfg:
             ansible_galaxy(galaxy_cfg, ansible)
 
         if pull_cfg:
-            run_ansible_pull(ansible, deepcopy(pull_cfg))
+            # pull cfg is a flat dict of primitives, so a shallow copy
+            # is enough for run_ansible_pull to pop keys without
+            # mutating the caller's cfg; deepcopy is much slower
+            run_ansible_pull(ansible, dict(pull_cfg))
 
         if setup_controller:
             ansible_controller(setup_controller, ansible)
 
 
 def validate_config(cfg: dict):
+    # validation is pure, so re-validating an identical cfg (module
+    # re-runs, tests sharing one config) can be answered from a cache
+    # keyed on the cfg's canonical JSON form; failures are not cached
+    # because lru_cache does not memoize raised exceptions
+    _validate_config_cached(json.dumps(cfg, sort_keys=True, default=str))
+
+
+# the subset of the cloud-config schema this module depends on at
+# runtime; compiled into a validator once so validation is a single
+# traversal of the cfg instead of many partial get_cfg_by_path walks
+_ANSIBLE_CFG_SCHEMA = {
+    "type": "object",
+    "required": ["install_method", "package_name"],
+    "properties": {
+        "install_method": {"enum": ["pip", "distro"]},
+        "package_name": {"type": "string", "minLength": 1},
+        "pull": {
+            "type": "object",
+            "required": ["url", "playbook_name"],
+            "properties": {
+                "url": {"type": "string", "minLength": 1},
+                "playbook_name": {"type": "string", "minLength": 1},
+            },
+        },
+        "setup_controller": {
+            "type": "object",
+            "anyOf": [
+                {
+                    "required": ["repositories"],
+                    "properties": {
+                        "repositories": {"type": "array", "minItems": 1}
+                    },
+                },
+                {
+                    "required": ["run_ansible"],
+                    "properties": {
+                        "run_ansible": {"type": "array", "minItems": 1}
+                    },
+                },
+            ],
+        },
+    },
+}
+
+
+@functools.lru_cache(maxsize=None)
+def _get_validator():
+    """compiled schema validator, or None without python3-jsonschema"""
+    try:
+        from jsonschema import Draft4Validator
+    except ImportError:
+        return None
+    return Draft4Validator(_ANSIBLE_CFG_SCHEMA)
+
+
+@functools.lru_cache(maxsize=32)
+def _validate_config_cached(cfg_json: str):
+    cfg = json.loads(cfg_json)
+    validator = _get_validator()
+    if validator is not None:
+        for err in validator.iter_errors(cfg):
+            raise ValueError(f"Invalid ansible config: {err.message}")
+        return
+
+    # hand-rolled checks for hosts without jsonschema
     required_keys = (
         "install_method",
         "package_name",
@@ -195,15 +378,6 @@ def validate_config(cfg: dict):
         raise ValueError("Invalid install method {install}")
 
 
-def filter_args(cfg: dict) -> dict:
-    """remove boolean false values"""
-    return {
-        key.replace("_", "-"): value
-        for (key, value) in cfg.items()
-        if value is not False
-    }
-
-
 def run_ansible_pull(pull: AnsiblePull, cfg: dict):
     playbook_name: str = cfg.pop("playbook_name")
 
@@ -217,15 +391,18 @@ def run_ansible_pull(pull: AnsiblePull, cfg: dict):
                 f"Ansible version {v.major}.{v.minor}.{v.patch}"
                 "doesn't support --diff flag, exiting."
             )
-    stdout = pull.pull(
+    # one pass over the cfg: drop False values, bare flag for True,
+    # --key=value for everything else
+    pull.pull(
         *[
-            f"--{key}={value}" if value is not True else f"--{key}"
-            for key, value in filter_args(cfg).items()
+            f"--{key.replace('_', '-')}"
+            if value is True
+            else f"--{key.replace('_', '-')}={value}"
+            for key, value in cfg.items()
+            if value is not False
         ],
         playbook_name,
     )
-    if stdout:
-        sys.stdout.write(f"{stdout}")
 
 
 def ansible_galaxy(cfg: dict, ansible: AnsiblePull):
@@ -233,21 +410,53 @@ def ansible_galaxy(cfg: dict, ansible: AnsiblePull):
 
     if not actions:
         LOG.warning("Invalid config: %s", cfg)
+        return
+
+    # ansible-galaxy accepts several install targets per invocation,
+    # so merge consecutive actions that differ only in their final
+    # argument and pay the interpreter startup once per batch; order
+    # between different kinds of actions is preserved
+    groups: list = []  # [command prefix, [targets]]
     for command in actions:
-        ansible.do_as(command)
+        prefix, target = command[:-1], command[-1:]
+        if groups and prefix and groups[-1][0] == prefix:
+            groups[-1][1].extend(target)
+        else:
+            groups.append([list(prefix), list(target)])
+    for prefix, targets in groups:
+        ansible.do_as([*prefix, *targets])
 
 
 def ansible_controller(cfg: dict, ansible: AnsiblePull):
-    for repository in cfg.get("repositories", []):
-        ansible.do_as(
-            ["git", "clone", repository["source"], repository["path"]]
-        )
+    repositories = cfg.get("repositories", [])
+    if repositories:
+        # clones to distinct paths are independent and network-bound,
+        # so fetch them concurrently; playbook runs below stay
+        # sequential since they may depend on each other
+        with ThreadPoolExecutor(max_workers=min(8, len(repositories))) as pool:
+            list(
+                pool.map(
+                    lambda repository: ansible.do_as(
+                        [
+                            "git",
+                            "clone",
+                            repository["source"],
+                            repository["path"],
+                        ]
+                    ),
+                    repositories,
+                )
+            )
     for args in cfg.get("run_ansible", []):
         playbook_dir = args.pop("playbook_dir")
         playbook_name = args.pop("playbook_name")
         command = [
             "ansible-playbook",
             playbook_name,
-            *[f"--{key}={value}" for key, value in filter_args(args).items()],
+            *[
+                f"--{key.replace('_', '-')}={value}"
+                for key, value in args.items()
+                if value is not False
+            ],
         ]
         ansible.do_as(command, cwd=playbook_dir)
@@ -1,8 +1,12 @@
 # This file is part of cloud-init. See LICENSE file for license information.
+import functools
+import itertools
 import logging
 import os
 import re
-import uuid
+import shlex
+import time
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum
 from pathlib import Path
 from tempfile import NamedTemporaryFile
@@ -30,10 +34,26 @@ except ImportError:
 
 log = logging.getLogger("integration_testing")
 
+_PPA_PIN_RE = re.compile(r"[^a-z0-9-]")
+_PPA_PREFERENCES_TMPL = (
+    "package: cloud-init\n"
+    "Pin: release o=LP-PPA-{origin}\n"
+    "Pin-Priority: 1001\n"
+)
 
-def _get_tmp_path():
-    tmp_filename = str(uuid.uuid4())
-    return "/var/tmp/{}.tmp".format(tmp_filename)
+
+@functools.lru_cache(maxsize=1)
+def _coverage_version() -> str:
+    """pinned coverage version; the file can't change mid-session"""
+    integration_requirements = Path(
+        cloud_init_project_dir("integration-requirements.txt")
+    ).read_text()
+    for line in integration_requirements.splitlines():
+        if line.startswith("coverage=="):
+            return line.split("==")[1]
+    raise RuntimeError(
+        "Could not find coverage in integration-requirements.txt"
+    )
 
 
 class CloudInitSource(Enum):
@@ -67,6 +87,31 @@ class IntegrationInstance:
         self.instance = instance
         self.settings = settings
         self._ip = ""
+        # one remote tmp dir per instance with monotonically numbered
+        # files; cheaper than generating a fresh uuid path per transfer
+        # and keeps all test tmp files in one place
+        self._tmp_dir = "/var/tmp/ci-it-{}-{:x}".format(os.getpid(), id(self))
+        self._tmp_count = itertools.count()
+        self._tmp_dir_created = False
+
+    @classmethod
+    def bulk_run(cls, instances, fn_name: str, *args, max_workers=16, **kw):
+        """Run the same method concurrently across many instances.
+
+        Setup steps like install_coverage or install_new_cloud_init are
+        SSH-latency bound and independent per instance, so a test
+        session touching N instances shouldn't pay N sequential
+        round-trip chains. Threads suffice because pycloudlib SSH
+        sessions are per-instance. Returns results in instance order;
+        the first raised exception propagates.
+        """
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return list(
+                executor.map(
+                    lambda instance: getattr(instance, fn_name)(*args, **kw),
+                    instances,
+                )
+            )
 
     def destroy(self):
         if isinstance(self.instance, GceInstance):
@@ -87,13 +132,31 @@ class IntegrationInstance:
             raise RuntimeError("Root user cannot run unprivileged")
         return self.instance.execute(command, use_sudo=use_sudo)
 
+    def _get_tmp_path(self) -> str:
+        if not self._tmp_dir_created:
+            # 1777 like /tmp so the unprivileged ssh user can push here
+            assert self.execute("mkdir -m 1777 -p {}".format(self._tmp_dir)).ok
+            self._tmp_dir_created = True
+        return "{}/{}.tmp".format(self._tmp_dir, next(self._tmp_count))
+
     def pull_file(
         self,
         remote_path: Union[str, os.PathLike],
         local_path: Union[str, os.PathLike],
     ):
-        # First copy to a temporary directory because of permissions issues
-        tmp_path = _get_tmp_path()
+        try:
+            # most files are readable by the ssh user, and a direct
+            # pull costs one SSH session instead of two
+            self.instance.pull_file(str(remote_path), str(local_path))
+            return
+        except Exception as e:
+            log.debug(
+                "Direct pull of %s failed (%s), retrying via tmp copy",
+                remote_path,
+                e,
+            )
+        # Copy to a temporary directory because of permissions issues
+        tmp_path = self._get_tmp_path()
         self.instance.execute("cp {} {}".format(str(remote_path), tmp_path))
         self.instance.pull_file(tmp_path, str(local_path))
 
@@ -102,8 +165,19 @@ class IntegrationInstance:
         local_path: Union[str, os.PathLike],
         remote_path: Union[str, os.PathLike],
     ):
-        # First push to a temporary directory because of permissions issues
-        tmp_path = _get_tmp_path()
+        try:
+            # writable destinations don't need the tmp push + sudo mv
+            # round-trip
+            self.instance.push_file(str(local_path), str(remote_path))
+            return
+        except Exception as e:
+            log.debug(
+                "Direct push to %s failed (%s), retrying via tmp copy",
+                remote_path,
+                e,
+            )
+        # Push to a temporary directory because of permissions issues
+        tmp_path = self._get_tmp_path()
         self.instance.push_file(str(local_path), tmp_path)
         assert self.execute("mv {} {}".format(tmp_path, str(remote_path))).ok
 
@@ -126,8 +200,17 @@ class IntegrationInstance:
         return result.stdout
 
     def write_to_file(self, remote_path, contents: str):
-        # Writes file locally and then pushes it rather
-        # than writing the file directly on the instance
+        # Most writes are small config snippets; streaming them through
+        # the existing SSH session skips a local tmp file plus the
+        # push/mv hops. Large payloads still go the push_file route to
+        # stay clear of remote argv size limits.
+        if len(contents) < 64 * 1024:
+            assert self.execute(
+                "printf %s {} > {}".format(
+                    shlex.quote(contents), shlex.quote(str(remote_path))
+                )
+            ).ok
+            return
         with NamedTemporaryFile("w", delete=False) as tmp_file:
             tmp_file.write(contents)
 
@@ -143,18 +226,7 @@ class IntegrationInstance:
 
     def install_coverage(self):
         # Determine coverage version from integration-requirements.txt
-        integration_requirements = Path(
-            cloud_init_project_dir("integration-requirements.txt")
-        ).read_text()
-        coverage_version = ""
-        for line in integration_requirements.splitlines():
-            if line.startswith("coverage=="):
-                coverage_version = line.split("==")[1]
-                break
-        else:
-            raise RuntimeError(
-                "Could not find coverage in integration-requirements.txt"
-            )
+        coverage_version = _coverage_version()
 
         # Update and install coverage from pip
         # We use pip because the versions between distros are incompatible
@@ -180,25 +252,27 @@ class IntegrationInstance:
         clean=True,
     ):
         if source == CloudInitSource.DEB_PACKAGE:
-            self.install_deb()
+            result = self.install_deb()
         elif source == CloudInitSource.PPA:
-            self.install_ppa()
+            result = self.install_ppa()
         elif source == CloudInitSource.PROPOSED:
-            self.install_proposed_image()
+            result = self.install_proposed_image()
         elif source == CloudInitSource.UPGRADE:
-            self.upgrade_cloud_init()
+            result = self.upgrade_cloud_init()
         else:
             raise RuntimeError(
                 "Specified to install {} which isn't supported here".format(
                     source
                 )
             )
-        version = self.execute("cloud-init -v").split()[-1]
+        # each installer chains cloud-init -v onto its final command, so
+        # the version arrives in the same SSH session as the install
+        version = result.splitlines()[-1].split()[-1]
         log.info("Installed cloud-init version: %s", version)
         if clean:
             self.instance.clean()
 
-    def install_proposed_image(self):
+    def install_proposed_image(self) -> Result:
         log.info("Installing proposed image")
         assert self.execute(
             'echo deb "http://archive.ubuntu.com/ubuntu '
@@ -206,11 +280,14 @@ class IntegrationInstance:
             "/etc/apt/sources.list.d/proposed.list"
         ).ok
         self._apt_update()
-        assert self.execute(
+        result = self.execute(
             "apt-get install -qy cloud-init -t=$(lsb_release -sc)-proposed"
-        ).ok
+            " && cloud-init -v"
+        )
+        assert result.ok
+        return result
 
-    def install_ppa(self):
+    def install_ppa(self) -> Result:
         log.info("Installing PPA")
         if self.execute("which add-apt-repository").failed:
             log.info("Installing missing software-properties-common package")
@@ -219,22 +296,36 @@ class IntegrationInstance:
                 "apt install -qy software-properties-common"
             ).ok
         pin_origin = self.settings.CLOUD_INIT_SOURCE[4:]  # Drop leading ppa:
-        pin_origin = re.sub("[^a-z0-9-]", "-", pin_origin)
+        pin_origin = _PPA_PIN_RE.sub("-", pin_origin)
         self.write_to_file(
             "/etc/apt/preferences.d/cloud-init-integration-testing",
-            f"package: cloud-init\nPin: release o=LP-PPA-{pin_origin}\n"
-            "Pin-Priority: 1001\n",
+            _PPA_PREFERENCES_TMPL.format(origin=pin_origin),
         )
         assert self.execute(
             "add-apt-repository {} -y".format(self.settings.CLOUD_INIT_SOURCE)
         ).ok
-        # PIN this PPA as priority for cloud-init installs regardless of ver
-        assert self.execute(
-            "apt-get install -qy cloud-init --allow-downgrades"
-        ).ok
+        # PIN this PPA as priority for cloud-init installs regardless of ver.
+        # apt may still hold its lock shortly after boot: retry with
+        # exponential backoff so we re-check quickly while the lock is
+        # likely to free, fail fast on any non-lock error, and give up
+        # after five minutes
+        delay = 0.5
+        deadline = time.monotonic() + 300
+        while True:
+            result = self.execute(
+                "apt-get install -qy cloud-init --allow-downgrades"
+                " && cloud-init -v"
+            )
+            if result.ok:
+                return result
+            # only lock contention is worth retrying
+            assert "lock" in result.stderr.lower(), result.stderr
+            assert time.monotonic() < deadline, result.stderr
+            time.sleep(delay)
+            delay = min(delay * 1.5, 10.0)
 
     @retry(tries=30, delay=1)
-    def install_deb(self):
+    def install_deb(self) -> Result:
         log.info("Installing deb package")
         deb_path = integration_settings.CLOUD_INIT_SOURCE
         deb_name = os.path.basename(deb_path)
@@ -247,15 +338,22 @@ class IntegrationInstance:
         # to install missing dependency errors due to stale cache.
         self.execute("apt update")
         # Use apt install instead of dpkg -i to pull in any changed pkg deps
-        assert self.execute(
+        result = self.execute(
             f"apt install {remote_path} --yes --allow-downgrades"
-        ).ok
+            " && cloud-init -v"
+        )
+        assert result.ok
+        return result
 
     @retry(tries=30, delay=1)
-    def upgrade_cloud_init(self):
+    def upgrade_cloud_init(self) -> Result:
         log.info("Upgrading cloud-init to latest version in archive")
         self._apt_update()
-        assert self.execute("apt-get install -qy cloud-init").ok
+        result = self.execute(
+            "apt-get install -qy cloud-init && cloud-init -v"
+        )
+        assert result.ok
+        return result
 
     def _apt_update(self):
         """Run an apt update.
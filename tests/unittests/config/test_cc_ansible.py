@@ -1,3 +1,4 @@
+import builtins
 import os
 import re
 from copy import deepcopy
@@ -5,9 +6,9 @@ from textwrap import dedent
 from unittest import mock
 from unittest.mock import MagicMock
 
-from pytest import mark, param, raises
+from pytest import fixture, mark, param, raises
 
-from cloudinit import util
+from cloudinit import subp, util
 from cloudinit.config import cc_ansible
 from cloudinit.config.schema import (
     SchemaValidationError,
@@ -146,6 +147,20 @@ CFG_MINIMAL = {
 }
 
 
+@fixture(autouse=True)
+def clear_userbase_cache():
+    """userbase lookups are cached per user across instances"""
+    cc_ansible.AnsiblePullPip._userbase_cache.clear()
+
+
+def _mock_pull_popen(m_popen):
+    """configure a Popen mock to look like a successful ansible-pull"""
+    process = m_popen.return_value
+    process.stdout = iter(())
+    process.returncode = 0
+    return process
+
+
 class TestSchema:
     @mark.parametrize(
         ("config", "error_msg"),
@@ -228,34 +243,6 @@ class TestSchema:
 
 
 class TestAnsible:
-    def test_filter_args(self):
-        """only diff should be removed"""
-        out = cc_ansible.filter_args(
-            CFG_FULL_PULL.get("ansible", {}).get("pull", {})
-        )
-        assert out == {
-            "url": "https://github/holmanb/vmboot",
-            "playbook-name": "arch.yml",
-            "accept-host-key": True,
-            "clean": True,
-            "full": True,
-            "ssh-common-args": "-y",
-            "scp-extra-args": "-l",
-            "sftp-extra-args": "-f",
-            "checkout": "tree",
-            "module-path": "~/.ansible/plugins/modules:"
-            "/usr/share/ansible/plugins/modules",
-            "timeout": "10",
-            "vault-id": "me",
-            "connection": "smart",
-            "vault-password-file": "/path/to/file",
-            "module-name": "git",
-            "sleep": "1",
-            "tags": "cumulus",
-            "skip-tags": "cisco",
-            "private-key": "{nope}",
-        }
-
     @mark.parametrize(
         ("cfg", "exception"),
         (
@@ -289,6 +276,7 @@ class TestAnsible:
     def test_required_keys(self, cfg, exception, mocker):
         mocker.patch(M_PATH + "subp.subp", return_value=("", ""))
         mocker.patch(M_PATH + "subp.which", return_value=True)
+        _mock_pull_popen(mocker.patch(M_PATH + "subprocess.Popen"))
         mocker.patch(M_PATH + "AnsiblePull.check_deps")
         mocker.patch(
             M_PATH + "AnsiblePull.get_version",
@@ -332,12 +320,26 @@ class TestAnsible:
 
     @mock.patch(M_PATH + "subp.subp", return_value=("stdout", "stderr"))
     @mock.patch(M_PATH + "subp.which", return_value=False)
-    def test_pip_bootstrap(self, m_which, m_subp):
+    @mock.patch(M_PATH + "pwd.getpwnam", side_effect=KeyError)
+    def test_pip_bootstrap(self, m_getpwnam, m_which, m_subp):
         distro = get_cloud(mocked_distro=True).distro
-        with mock.patch("builtins.__import__", side_effect=ImportError):
+        distro.do_as.side_effect = [
+            ("stdout", "stderr"),  # site.getuserbase()
+            subp.ProcessExecutionError,  # pip show: ansible not installed
+            ("stdout", "stderr"),  # pip install --upgrade pip ansible
+        ]
+        real_import = builtins.__import__
+
+        def fake_import(name, *args, **kwargs):
+            if name == "pip":
+                raise ImportError
+            return real_import(name, *args, **kwargs)
+
+        with mock.patch("builtins.__import__", side_effect=fake_import):
             cc_ansible.AnsiblePullPip(distro, "ansible").install("")
         distro.install_packages.assert_called_once()
 
+    @mock.patch(M_PATH + "subprocess.Popen")
     @mock.patch(M_PATH + "subp.which", return_value=True)
     @mock.patch(M_PATH + "subp.subp", return_value=("stdout", "stderr"))
     @mock.patch(
@@ -382,8 +384,11 @@ class TestAnsible:
             ),
         ),
     )
-    def test_ansible_pull(self, m_subp1, m_subp2, m_which, cfg, expected):
+    def test_ansible_pull(
+        self, m_subp1, m_subp2, m_which, m_popen, cfg, expected
+    ):
         """verify expected ansible invocation from userdata config"""
+        _mock_pull_popen(m_popen)
         pull_type = cfg["ansible"]["install_method"]
         distro = get_cloud().distro
         ansible_pull = (
@@ -396,10 +401,43 @@ class TestAnsible:
         )
 
         if pull_type != "pip":
-            assert m_subp2.call_args[0][0] == expected
-            assert m_subp2.call_args[1]["update_env"].get(
-                "HOME"
-            ) == os.environ.get("HOME", "/root")
+            assert m_popen.call_args[0][0] == expected
+            assert m_popen.call_args[1]["env"].get("HOME") == os.environ.get(
+                "HOME", "/root"
+            )
+
+    def test_galaxy_batches_matching_actions(self):
+        """consecutive same-command actions collapse to one subprocess"""
+        ansible = mock.MagicMock(spec=cc_ansible.AnsiblePull)
+        cc_ansible.ansible_galaxy(
+            {
+                "actions": [
+                    ["ansible-galaxy", "collection", "install", "a.b"],
+                    ["ansible-galaxy", "collection", "install", "c.d"],
+                    ["ansible-galaxy", "role", "install", "e.f"],
+                ]
+            },
+            ansible,
+        )
+        assert ansible.do_as.call_args_list == [
+            mock.call(
+                ["ansible-galaxy", "collection", "install", "a.b", "c.d"]
+            ),
+            mock.call(["ansible-galaxy", "role", "install", "e.f"]),
+        ]
+
+    def test_controller_clones_all_repositories(self):
+        """every configured repository is cloned, order-independent"""
+        ansible = mock.MagicMock(spec=cc_ansible.AnsiblePull)
+        cfg = deepcopy(CFG_CTRL["ansible"]["setup_controller"])
+        cfg["run_ansible"] = []
+        cc_ansible.ansible_controller(cfg, ansible)
+        cloned = {call[0][0][2] for call in ansible.do_as.call_args_list}
+        assert cloned == {
+            "git@github.com:holmanb/ansible-lxd-public.git",
+            "git@github.com:holmanb/ansible-lxd-private.git",
+            "git@github.com:holmanb/vmboot.git",
+        }
 
     @mock.patch(M_PATH + "validate_config")
     def test_do_not_run(self, m_validate):
@@ -427,9 +465,11 @@ class TestAnsible:
         expected = util.Version(2, 13, 2)
         assert received == expected
 
+    @mock.patch(M_PATH + "subprocess.Popen")
     @mock.patch(M_PATH + "subp.subp", return_value=("stdout", "stderr"))
     @mock.patch(M_PATH + "subp.which", return_value=True)
-    def test_ansible_env_var(self, m_which, m_subp):
+    def test_ansible_env_var(self, m_which, m_subp, m_popen):
+        _mock_pull_popen(m_popen)
         cc_ansible.handle("", CFG_FULL_PULL, get_cloud(), [])
 
         # python 3.8 required for Mock.call_args.kwargs dict attribute
@@ -438,3 +478,27 @@ class TestAnsible:
                 "/etc/ansible/ansible.cfg"
                 == m_subp.call_args.kwargs["update_env"]["ansible_config"]
             )
+
+    @mock.patch(M_PATH + "subprocess.Popen")
+    @mock.patch(M_PATH + "subp.subp", return_value=("stdout", "stderr"))
+    @mock.patch(M_PATH + "subp.which", return_value=True)
+    def test_ansible_pipelining_env(self, m_which, m_subp, m_popen):
+        """transport tuning is default but yields to a user config file"""
+        _mock_pull_popen(m_popen)
+        with mock.patch.dict("os.environ"):
+            os.environ.pop("ANSIBLE_PIPELINING", None)
+            os.environ.pop("ANSIBLE_SSH_ARGS", None)
+            ansible = cc_ansible.AnsiblePullDistro(get_cloud().distro)
+            assert ansible.env["ANSIBLE_PIPELINING"] == "True"
+            assert "ControlPersist" in ansible.env["ANSIBLE_SSH_ARGS"]
+
+            # pre-set environment variables are the opt-out knob
+            os.environ["ANSIBLE_PIPELINING"] = "False"
+            ansible = cc_ansible.AnsiblePullDistro(get_cloud().distro)
+            assert "ANSIBLE_PIPELINING" not in ansible.env
+
+            # an explicit ansible_config wins: env vars would override it
+            cc_ansible.handle("", CFG_FULL_PULL, get_cloud(), [])
+            update_env = m_subp.call_args.kwargs["update_env"]
+            assert "ANSIBLE_PIPELINING" not in update_env
+            assert "ANSIBLE_SSH_ARGS" not in update_env